@@ -17,13 +17,13 @@
 # SPDX-License-Identifier: Apache-2.0
 # Copyright (c) OWASP Foundation. All Rights Reserved.
 
-import io
 import json
 import os
 import sys
-import xml.etree.ElementTree
+import warnings
 from datetime import datetime, timezone
-from typing import Any
+from functools import lru_cache
+from typing import Any, Callable, Dict, Tuple
 from unittest import TestCase
 from uuid import uuid4
 
@@ -32,36 +32,146 @@ from lxml.etree import DocumentInvalid
 from xmldiff import main
 from xmldiff.actions import MoveNode
 
+from cyclonedx.model import ThisTool
 from cyclonedx.output import SchemaVersion
 
 if sys.version_info >= (3, 7):
-    from jsonschema import ValidationError, validate as json_validate
-
-if sys.version_info >= (3, 8, 0):
-    from importlib.metadata import version
-else:
-    from importlib_metadata import version  # type: ignore
+    from jsonschema import ValidationError
+    from jsonschema.validators import validator_for
+
+    # opt-in via `CYCLONEDX_TESTS_FASTJSONSCHEMA=1`: `fastjsonschema` compiles schemas to Python code, which validates
+    # considerably faster than `jsonschema` - but it is no dev-dependency, and its `format` checks differ
+    if os.environ.get('CYCLONEDX_TESTS_FASTJSONSCHEMA') == '1':
+        import fastjsonschema
+        _json_validation_errors: Tuple[type, ...] = (ValidationError, fastjsonschema.JsonSchemaValueException)
+    else:
+        fastjsonschema = None
+        _json_validation_errors = (ValidationError,)
 
 cyclonedx_lib_name: str = 'cyclonedx-python-lib'
-cyclonedx_lib_version: str = version(cyclonedx_lib_name)
 single_uuid: str = 'urn:uuid:{}'.format(uuid4())
 schema_directory = os.path.join(os.path.dirname(__file__), '../cyclonedx/schema')
 
 
+# JSON keys of the arrays that the model holds in (unordered) `set`s, so whose order differs from run to run
+_JSON_SET_ARRAYS = frozenset((
+    'advisories', 'affects', 'aliases', 'ancestors', 'authors', 'commits', 'components', 'contact', 'copyright',
+    'cwes', 'data', 'dependencies', 'dependsOn', 'descendants', 'endpoints', 'externalReferences', 'hashes',
+    'individuals', 'licenses', 'notes', 'organizations', 'patches', 'properties', 'ratings', 'references',
+    'resolves', 'response', 'services', 'tags', 'tools', 'url', 'variants', 'versions', 'vulnerabilities',
+))
+
+
+# compact, with sorted keys - one shared encoder, as `json.dumps()` builds a new one per call for non-default options
+_canonical_json = json.JSONEncoder(sort_keys=True, separators=(',', ':')).encode
+
+
+@lru_cache(maxsize=None)
+def _bom_xpaths(namespace: str) -> Tuple[etree.XPath, etree.XPath]:
+    """
+    Compiled XPaths to the metadata timestamp, and to the version of 'this' Tool, for the given BOM namespace.
+    """
+    namespaces = {'bom': namespace}
+    return (
+        etree.XPath('./bom:metadata/bom:timestamp', namespaces=namespaces),
+        etree.XPath('.//*/bom:tool[bom:version="VERSION"]/bom:version', namespaces=namespaces)
+    )
+
+
+# Compiled schemas, keyed by `SchemaVersion` - loading and compiling a schema is far more expensive than validating
+# against it, so each is done once only, on first use. The caches are plain module state and so are filled lazily per
+# process, which keeps them correct (and lock-free) under process-parallel runners such as `pytest-xdist`.
+_json_validators: Dict[SchemaVersion, Callable[[Any], Any]] = {}
+_xml_schemas: Dict[SchemaVersion, etree.XMLSchema] = {}
+
+
+# Permissive stand-ins for referenced schemas that are not bundled. The JSON Signature Format schema only describes
+# `signature`s, which no BOM generated by this library contains.
+_json_schema_ref_stubs: Dict[str, Any] = {
+    'jsf-0.82.schema.json': {'definitions': {'signature': {}}},
+}
+
+
+def _load_json_schema_ref(uri: str) -> Any:
+    """
+    Resolve a `$ref` to the bundled copy of the schema, or its stub - never fetch it over the network.
+    """
+    schema_name = uri.rsplit('/', 1)[-1]
+    if schema_name in _json_schema_ref_stubs:
+        return _json_schema_ref_stubs[schema_name]
+    schema_fn = os.path.join(schema_directory, schema_name)
+    if not os.path.isfile(schema_fn):
+        raise fastjsonschema.JsonSchemaDefinitionException(f'Referenced schema {uri} is not bundled')
+    with open(schema_fn) as schema_fd:
+        return json.load(schema_fd)
+
+
+def _json_schema_fn(schema_version: SchemaVersion) -> str:
+    return os.path.join(schema_directory, f'bom-{schema_version.to_version()}.schema.json')
+
+
+def _xml_schema_fn(schema_version: SchemaVersion) -> str:
+    return os.path.join(schema_directory, f'bom-{schema_version.to_version()}.xsd')
+
+
+def _compile_json_schema(schema_version: SchemaVersion) -> Callable[[Any], Any]:
+    with open(_json_schema_fn(schema_version)) as schema_fd:
+        schema_doc = json.load(schema_fd)
+
+    if fastjsonschema is not None:
+        try:
+            # `use_default=False`: validate only, never fill in default values on the instance
+            return fastjsonschema.compile(
+                schema_doc, handlers={'http': _load_json_schema_ref}, use_default=False
+            )
+        except fastjsonschema.JsonSchemaDefinitionException as e:
+            # e.g. a referenced schema is not bundled - `jsonschema` only resolves references once an instance
+            # needs them
+            warnings.warn(
+                f'fastjsonschema could not compile the JSON schema for {schema_version.to_version()}, '
+                f'falling back to jsonschema: {e}'
+            )
+
+    validator_cls = validator_for(schema_doc)
+    validator_cls.check_schema(schema_doc)
+    return validator_cls(schema_doc).validate
+
+
+def _compile_xml_schema(schema_version: SchemaVersion) -> etree.XMLSchema:
+    return etree.XMLSchema(etree.parse(_xml_schema_fn(schema_version)))
+
+
+def _get_json_validator(schema_version: SchemaVersion) -> Callable[[Any], Any]:
+    if schema_version not in _json_validators:
+        _json_validators[schema_version] = _compile_json_schema(schema_version)
+    return _json_validators[schema_version]
+
+
+def _get_xml_schema(schema_version: SchemaVersion) -> etree.XMLSchema:
+    if schema_version not in _xml_schemas:
+        _xml_schemas[schema_version] = _compile_xml_schema(schema_version)
+    return _xml_schemas[schema_version]
+
+
+def _parse_xml(xml_str: str) -> etree._Element:
+    return etree.fromstring(
+        xml_str.encode('utf-8'), etree.XMLParser(remove_blank_text=True, remove_comments=True)
+    )
+
+
 class BaseJsonTestCase(TestCase):
 
+    # BOMs are big - always show the full diff of a failed comparison
+    maxDiff = None
+
     def assertValidAgainstSchema(self, bom_json: str, schema_version: SchemaVersion) -> None:
-        if sys.version_info >= (3, 7):
-            schema_fn = os.path.join(
-                schema_directory,
-                f'bom-{schema_version.name.replace("_", ".").replace("V", "")}.schema.json'
-            )
-            with open(schema_fn) as schema_fd:
-                schema_doc = json.load(schema_fd)
+        self._assertValidAgainstSchemaObj(json.loads(bom_json), schema_version)
 
+    def _assertValidAgainstSchemaObj(self, bom: Any, schema_version: SchemaVersion) -> None:
+        if sys.version_info >= (3, 7):
             try:
-                json_validate(instance=json.loads(bom_json), schema=schema_doc)
-            except ValidationError as e:
+                _get_json_validator(schema_version)(bom)
+            except _json_validation_errors as e:
                 self.assertTrue(False, f'Failed to validate SBOM against JSON schema: {str(e)}')
 
             self.assertTrue(True)
@@ -69,26 +179,48 @@ class BaseJsonTestCase(TestCase):
             self.assertTrue(True, 'JSON Schema Validation is not possible in Python < 3.7')
 
     @staticmethod
-    def _sort_json_dict(item: object) -> Any:
+    def _sort_json_set_arrays(item: Any) -> None:
+        """
+        Order, in place, the (nested) arrays that the model holds in (unordered) `set`s - see `_JSON_SET_ARRAYS`.
+        All other arrays keep their order, so that it is compared too.
+        """
         if isinstance(item, dict):
-            return sorted((key, BaseJsonTestCase._sort_json_dict(values)) for key, values in item.items())
-        if isinstance(item, list):
-            return sorted(BaseJsonTestCase._sort_json_dict(x) for x in item)
-        else:
-            return item
+            for key, value in item.items():
+                if isinstance(value, list):
+                    BaseJsonTestCase._sort_json_set_arrays(value)
+                    if len(value) > 1 and key in _JSON_SET_ARRAYS:
+                        value.sort(key=_canonical_json)
+                elif isinstance(value, dict):
+                    BaseJsonTestCase._sort_json_set_arrays(value)
+        elif isinstance(item, list):
+            for value in item:
+                if isinstance(value, (dict, list)):
+                    BaseJsonTestCase._sort_json_set_arrays(value)
+
+    def _assertEqualJsonObj(self, a: Any, b: Any) -> None:
+        """
+        Compare the canonical JSON forms of two (already parsed) documents.
+
+        Arrays that come from `set`s are reordered in place, in both documents.
+        """
+        BaseJsonTestCase._sort_json_set_arrays(a)
+        BaseJsonTestCase._sort_json_set_arrays(b)
+        if _canonical_json(a) != _canonical_json(b):
+            # only indent on failure, so that it shows a line-by-line diff
+            self.assertEqual(json.dumps(a, sort_keys=True, indent=2), json.dumps(b, sort_keys=True, indent=2))
 
     def assertEqualJson(self, a: str, b: str) -> None:
-        self.assertEqual(
-            BaseJsonTestCase._sort_json_dict(json.loads(a)),
-            BaseJsonTestCase._sort_json_dict(json.loads(b))
-        )
+        self._assertEqualJsonObj(json.loads(a), json.loads(b))
 
     def assertEqualJsonBom(self, a: str, b: str) -> None:
+        self._assertEqualJsonBomObj(json.loads(a), json.loads(b))
+
+    def _assertEqualJsonBomObj(self, ab: Any, bb: Any) -> None:
         """
-        Remove UUID before comparison as this will be unique to each generation
-        """
-        ab, bb = json.loads(a), json.loads(b)
+        Remove UUID before comparison as this will be unique to each generation.
 
+        Both (already parsed) BOMs are modified in place.
+        """
         # Null serialNumbers
         ab['serialNumber'] = single_uuid
         bb['serialNumber'] = single_uuid
@@ -99,30 +231,22 @@ class BaseJsonTestCase(TestCase):
         bb['metadata']['timestamp'] = now.isoformat()
 
         # Align 'this' Tool Version
-        if 'tools' in ab['metadata'].keys():
-            for i, tool in enumerate(ab['metadata']['tools']):
-                if tool['name'] == cyclonedx_lib_name:
-                    ab['metadata']['tools'][i]['version'] = cyclonedx_lib_version
+        for bom in (ab, bb):
+            tools = bom.get('metadata', {}).get('tools') or ()
+            this_tool = next((tool for tool in tools if tool['name'] == cyclonedx_lib_name), None)
+            if this_tool is not None:
+                this_tool['version'] = ThisTool.version
 
-        if 'tools' in bb['metadata'].keys():
-            for i, tool in enumerate(bb['metadata']['tools']):
-                if tool['name'] == cyclonedx_lib_name:
-                    bb['metadata']['tools'][i]['version'] = cyclonedx_lib_version
-
-        self.assertEqualJson(json.dumps(ab), json.dumps(bb))
+        self._assertEqualJsonObj(ab, bb)
 
 
 class BaseXmlTestCase(TestCase):
 
     def assertValidAgainstSchema(self, bom_xml: str, schema_version: SchemaVersion) -> None:
-        xsd_fn = os.path.join(schema_directory, f'bom-{schema_version.name.replace("_", ".").replace("V", "")}.xsd')
-        with open(xsd_fn) as xsd_fd:
-            xsd_doc = etree.parse(xsd_fd)
-
-        xml_schema = etree.XMLSchema(xsd_doc)
+        xml_schema = _get_xml_schema(schema_version)
         schema_validates = False
         try:
-            schema_validates = xml_schema.validate(etree.parse(io.BytesIO(bytes(bom_xml, 'ascii'))))
+            schema_validates = xml_schema.validate(etree.fromstring(bom_xml.encode('utf-8')))
         except DocumentInvalid as e:
             print(f'Failed to validate SBOM against schema: {str(e)}')
 
@@ -131,41 +255,43 @@ class BaseXmlTestCase(TestCase):
         self.assertTrue(schema_validates, f'Failed to validate Generated SBOM against XSD Schema:'
                                           f'{bom_xml}')
 
-    def assertEqualXml(self, a: str, b: str) -> None:
-        diff_results = main.diff_texts(a, b, diff_options={'F': 0.5})
+    def _assertEqualXmlTree(self, a: etree._Element, b: etree._Element) -> None:
+        # Identical canonical forms are equal - only fall back to (the much slower) `xmldiff` when they are not, as
+        # it also tolerates re-ordered elements and produces a readable list of differences
+        if etree.tostring(a, method='c14n2', with_comments=False) == \
+                etree.tostring(b, method='c14n2', with_comments=False):
+            return
+
+        diff_results = main.diff_trees(a, b, diff_options={'F': 0.5})
         diff_results = list(filter(lambda o: not isinstance(o, MoveNode), diff_results))
-        self.assertEqual(len(diff_results), 0, f'There are XML differences: {diff_results}\n- {a}\n+ {b}')
+        self.assertEqual(
+            len(diff_results), 0,
+            f'There are XML differences: {diff_results}\n- {etree.tostring(a, encoding="unicode")}\n'
+            f'+ {etree.tostring(b, encoding="unicode")}'
+        )
+
+    def assertEqualXml(self, a: str, b: str) -> None:
+        self._assertEqualXmlTree(_parse_xml(a), _parse_xml(b))
 
     def assertEqualXmlBom(self, a: str, b: str, namespace: str) -> None:
         """
         Sanitise some fields such as timestamps which cannot have their values directly compared for equality.
         """
-        ba = xml.etree.ElementTree.fromstring(a, etree.XMLParser(remove_blank_text=True, remove_comments=True))
-        bb = xml.etree.ElementTree.fromstring(b, etree.XMLParser(remove_blank_text=True, remove_comments=True))
+        ba, bb = _parse_xml(a), _parse_xml(b)
 
         # Align serialNumbers
         ba.set('serialNumber', single_uuid)
         bb.set('serialNumber', single_uuid)
 
+        metadata_ts_xpath, this_tool_version_xpath = _bom_xpaths(namespace)
+
         # Align timestamps in metadata
         now = datetime.now(tz=timezone.utc)
-        metadata_ts_a = ba.find('./{{{}}}metadata/{{{}}}timestamp'.format(namespace, namespace))
-        if metadata_ts_a is not None:
-            metadata_ts_a.text = now.isoformat()
-
-        metadata_ts_b = bb.find('./{{{}}}metadata/{{{}}}timestamp'.format(namespace, namespace))
-        if metadata_ts_b is not None:
-            metadata_ts_b.text = now.isoformat()
+        for metadata_ts in metadata_ts_xpath(ba) + metadata_ts_xpath(bb):
+            metadata_ts.text = now.isoformat()
 
         # Align 'this' Tool Version
-        this_tool = ba.find('.//*/{{{}}}tool[{{{}}}version="VERSION"]'.format(namespace, namespace))
-        if this_tool is not None:
-            this_tool.find('./{{{}}}version'.format(namespace)).text = cyclonedx_lib_version
-        this_tool = bb.find('.//*/{{{}}}tool[{{{}}}version="VERSION"]'.format(namespace, namespace))
-        if this_tool is not None:
-            this_tool.find('./{{{}}}version'.format(namespace)).text = cyclonedx_lib_version
-
-        self.assertEqualXml(
-            xml.etree.ElementTree.tostring(ba, 'unicode'),
-            xml.etree.ElementTree.tostring(bb, 'unicode')
-        )
+        for this_tool_version in this_tool_version_xpath(ba) + this_tool_version_xpath(bb):
+            this_tool_version.text = ThisTool.version
+
+        self._assertEqualXmlTree(ba, bb)
@@ -17,6 +17,7 @@
 # SPDX-License-Identifier: Apache-2.0
 # Copyright (c) OWASP Foundation. All Rights Reserved.
 
+import json
 from os.path import dirname, join
 from unittest.mock import Mock, patch
 
@@ -340,8 +341,10 @@ class TestOutputJson(BaseJsonTestCase):
         self.assertEqual(outputter.schema_version, schema_version)
         with open(
                 join(dirname(__file__), f'fixtures/json/{schema_version.to_version()}/{fixture}')) as expected_json:
-            self.assertValidAgainstSchema(bom_json=outputter.output_as_string(), schema_version=schema_version)
-            self.assertEqualJsonBom(expected_json.read(), outputter.output_as_string())
+            bom_obj = json.loads(outputter.output_as_string())
+            self._assertValidAgainstSchemaObj(bom=bom_obj, schema_version=schema_version)
+            # modifies `bom_obj` in place - so only after it was validated
+            self._assertEqualJsonBomObj(json.load(expected_json), bom_obj)
             expected_json.close()
 
     def _validate_json_bom_not_supported(self, bom: Bom, schema_version: SchemaVersion) -> None: